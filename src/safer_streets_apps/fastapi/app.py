@@ -200,6 +200,29 @@ async def hex_counts(force: Force, category: CrimeType) -> DfJson:
     )
 
 
+@auth_routes.get("/hex_counts_wide")
+async def hex_counts_wide(
+    *,
+    force: Force,
+    category: CrimeType,
+    month: MonthStr | None = None,
+    lookback: Annotated[int, Query(ge=1, le=36)] = 36,
+) -> DfJson:
+    """
+    Returns counts for crimes aggregated to hexes for given force and category, with one row per spatial unit id and
+    one column per month in YYYY-MM format (zero where there were no crimes)
+
+    Args:
+        force: The police force to filter crimes by.
+        category: The crime type/category to filter by.
+        month: Optional last month in YYYY-MM format. Defaults to the latest available month.
+        lookback: Number of months to look back (1-36). Defaults to 36.
+    """
+    month_ = Month.parse_str(month) if month else latest_month()
+    months = Itr(monthgen(month_, backwards=True)).take(lookback).map(str).collect()
+    return impl.hex_counts_wide(app.state.con, force, category, months)
+
+
 # TODO potentially deprecate in favour of crime_counts
 @auth_routes.get("/census_counts", deprecated=True)
 async def census_counts(geography: CensusGeography, force: Force, category: CrimeType) -> DfJson:
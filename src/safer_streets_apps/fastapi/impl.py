@@ -1,6 +1,6 @@
 import geopandas as gpd
-from duckdb import DuckDBPyConnection
-from safer_streets_core.utils import fix_force_name
+from duckdb import DuckDBPyConnection, DuckDBPyRelation
+from safer_streets_core.utils import CrimeType, Force, fix_force_name
 
 from safer_streets_apps.fastapi import sql
 from safer_streets_apps.fastapi.models import CrimeCountsRequest, DfJson, FeaturesRequest
@@ -48,6 +48,19 @@ def crime_counts(con: DuckDBPyConnection, params: CrimeCountsRequest) -> DfJson:
     )
 
 
+def hex_counts_wide(con: DuckDBPyConnection, force: Force, category: CrimeType, months: list[str]) -> DfJson:
+    counts = con.sql(
+        sql.HEX_CRIME_COUNTS, params={"pfa": fix_force_name(force), "months": months, "crime_types": [category]}
+    )
+    return pivot_monthly_counts(counts, months)
+
+
+def pivot_monthly_counts(counts: DuckDBPyRelation, months: list[str]) -> DfJson:
+    "One row per spatial unit and one column per month, in the order given, zero where there were no crimes"
+    pivot_values = ", ".join("'{}'".format(month.replace("'", "''")) for month in months)
+    return counts.query("counts", sql.PIVOT_MONTHLY_COUNTS.format(months=pivot_values)).fetch_arrow_table().to_pylist()
+
+
 def features(con: DuckDBPyConnection, params: FeaturesRequest, latlon: bool) -> gpd.GeoDataFrame:
     match params.geography:
         case "H3":
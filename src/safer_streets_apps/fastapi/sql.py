@@ -118,6 +118,13 @@ RIGHT JOIN h ON h.spatial_unit = c.spatial_unit
 WHERE c.crime_type = $2
 """
 
+# pivots a relation (with spatial_unit, month and count columns), registered as "counts" via DuckDBPyRelation.query, to
+# one row per spatial unit and one column per month in {months}. Without an explicit IN list DuckDB expands PIVOT into
+# several statements, which DuckDBPyRelation.query can't run
+PIVOT_MONTHLY_COUNTS = """
+PIVOT counts ON month IN ({months}) USING COALESCE(SUM(count), 0)::INTEGER GROUP BY spatial_unit
+"""
+
 CENSUS_COUNTS = """
 WITH h AS (
     SELECT {geography}CD as spatial_unit, geometry FROM {geography}_boundaries
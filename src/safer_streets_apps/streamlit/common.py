@@ -2,10 +2,10 @@ from datetime import date
 from typing import Any
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import streamlit as st
 from dateutil.relativedelta import relativedelta
-from itrx import Itr
 from safer_streets_core.api_helpers import fetch_df, fetch_gdf
 from safer_streets_core.spatial import (
     SpatialUnit,
@@ -21,7 +21,6 @@ from safer_streets_core.utils import (
     data_dir,
     get_monthly_crime_counts,
     load_crime_data,
-    monthgen,
 )
 from safer_streets_core.utils import latest_month as core_latest_month
 
@@ -34,8 +33,21 @@ def cache_crime_data(force: Force, category: str) -> tuple[gpd.GeoDataFrame, gpd
 
 
 @st.cache_data
+def cache_centroid_and_boundary(force: Force, category: str) -> tuple[float, float, dict[str, Any]]:
+    """
+    Map centre and force boundary GeoJSON, which don't change with the other settings. Caching these means reruns don't
+    have to copy the whole crime dataset out of the cache just to average its coordinates
+    """
+    raw_data, boundary = cache_crime_data(force, category)
+    return raw_data.lat.mean(), raw_data.lon.mean(), boundary.to_crs(epsg=4326).__geo_interface__
+
+
+# census data is static, so persist it across restarts to avoid reloading it on a cold start
+@st.cache_data(persist="disk", max_entries=64)
 def cache_demographic_data(force: Force) -> gpd.GeoDataFrame:
     raw_population = load_population_data(force).to_crs(epsg=4326)
+    # categorical so groupbys on ethnicity use the integer codes rather than hashing strings
+    raw_population["C2021_ETH_20_NAME"] = raw_population["C2021_ETH_20_NAME"].astype("category")
     return raw_population
 
 
@@ -48,22 +60,47 @@ def latest_month() -> Month:
     return core_latest_month()
 
 
-@st.cache_data
-def get_oac() -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+# static lookups, so persisted like the census data. The large CSV is parsed with the multithreaded pyarrow reader
+@st.cache_data(persist="disk")
+def load_oac() -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    The hex to OA mapping, and the OA classification codes with their names for each level. The lookups are static
+    so the names are joined on here once, leaving callers a single merge
+    """
     hex_oa_mapping = pd.read_parquet(data_dir() / "hex-oa-mapping.parquet")
     oac_desc = pd.read_csv(data_dir() / "classification_codes_and_names-1.csv").set_index("Classification Code")[
         "Classification Name"
     ]
     oac_actual = (
-        pd.read_csv(data_dir() / "UK_OAC_Final.csv")
+        pd.read_csv(data_dir() / "UK_OAC_Final.csv", engine="pyarrow", dtype={"Supergroup": str})
         .set_index("Geography_Code")
         .rename(columns={"Supergroup": "supergroup_code", "Group": "group_code", "Subgroup": "subgroup_code"})
     )
-    oac_actual.supergroup_code = oac_actual.supergroup_code.astype(str)
-    return hex_oa_mapping, oac_actual, oac_desc
+    oac_full = (
+        oac_actual.merge(oac_desc.rename("Supergroup"), left_on="supergroup_code", right_index=True)
+        .merge(oac_desc.rename("Group"), left_on="group_code", right_index=True)
+        .merge(oac_desc.rename("Subgroup"), left_on="subgroup_code", right_index=True)
+    )
+    return hex_oa_mapping, oac_full
+
+
+@st.cache_resource
+def get_oac() -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    As load_oac, but shared rather than copied out of the cache on every call - the hex mapping is large and callers
+    only ever join against it. Don't modify the returned frames
+    """
+    return load_oac()
+
 
+@st.cache_resource
+def _all_months() -> list[Month]:
+    "The last 36 months, oldest first. Built once per process rather than on every page run"
+    latest = latest_month()
+    return [latest - i for i in range(35, -1, -1)]
 
-all_months = Itr(monthgen(latest_month(), backwards=True)).take(36).rev().collect()
+
+all_months = _all_months()
 
 
 geographies = {
@@ -82,16 +119,30 @@ def get_counts_and_features_old(
 ):
     crime_data, features = map_to_spatial_unit(raw_data, boundary, spatial_unit, **spatial_unit_params)
     # compute area in sensible units before changing crs!
-    features["area_km2"] = features.area / 1_000_000
+    area_km2 = features.geometry.area.to_numpy() / 1_000_000
     # now convert everything to Webmercator
     crime_data = crime_data.to_crs(epsg=4326)
     boundary = boundary.to_crs(epsg=4326)
     features = features.to_crs(epsg=4326)
-    # and aggregate
-    counts = get_monthly_crime_counts(crime_data, features)
+    features["area_km2"] = area_km2
+    # and aggregate, keeping rows aligned with features so they can be combined positionally
+    # (monthly counts are small, so int32 is plenty and halves the memory traffic of downstream array ops)
+    counts = get_monthly_crime_counts(crime_data, features).reindex(features.index, fill_value=0).astype(np.int32)
     return counts, features, boundary
 
 
+@st.cache_data
+def cache_counts_and_features(
+    force: Force, category: str, spatial_unit: SpatialUnit, **spatial_unit_params: Any
+) -> tuple[pd.DataFrame, gpd.GeoDataFrame, gpd.GeoDataFrame]:
+    """
+    Monthly counts, features (with area) and boundary for a force/category/spatial unit (e.g. an entry of
+    geographies). None of this depends on any of the other UI settings so only needs computing once per combination
+    """
+    raw_data, boundary = cache_crime_data(force, category)
+    return get_counts_and_features_old(raw_data, boundary, spatial_unit, **spatial_unit_params)
+
+
 @st.cache_data
 def get_boundary(force: Force) -> gpd.GeoDataFrame:
     # returns EPSG:4326, with area
@@ -120,6 +171,7 @@ def get_counts_and_features(
         )
         .set_index(["spatial_unit", "month"])["count"]
         .unstack(level="month", fill_value=0)
+        .astype(np.int32)
     )
 
     # GeoDataFrame.to_json resets the index and names it to "id"
@@ -129,21 +181,86 @@ def get_counts_and_features(
         .set_index("spatial_unit", drop=True)
     )
     # get the areas
-    features["area_km2"] = features.area / 1_000_000
+    area_km2 = features.geometry.area.to_numpy() / 1_000_000
     # now convert everything to Webmercator
     features = features.to_crs(epsg=4326)
+    features["area_km2"] = area_km2
 
     counts.index = counts.index.astype(str)
 
     return features, counts
 
 
+@st.cache_data
+def get_boundary_geometry(force: Force) -> dict[str, dict[str, Any]]:
+    "Serialised geometry of the force boundary (see to_feature_collection)"
+    return geometry_by_id(get_boundary(force))
+
+
+@st.cache_data
+def get_feature_geometry(
+    force: Force, geography: str, category: CrimeType, month: str, lookback: int
+) -> dict[str, dict[str, Any]]:
+    "Serialised geometry of the features returned by get_counts_and_features (see to_feature_collection)"
+    features, _ = get_counts_and_features(force, geography, category, month, lookback)
+    return geometry_by_id(features)
+
+
+# hex geometry is static, so it's safe to keep across restarts
+@st.cache_data(persist="disk", max_entries=128)
+def get_hexes(hex_ids: tuple[int, ...]) -> gpd.GeoDataFrame:
+    "Hex geometry in EPSG:4326. Nearby settings tend to select the same hexes, so this is often a cache hit"
+    hexes = fetch_gdf("hexes", list(hex_ids), http_post=True).set_index("id")
+    # TODO annoyingly comes back with a string index, can this be fixed?
+    hexes.index = hexes.index.astype(int)
+    # TODO also return in CRS we need for pydeck?
+    hexes = hexes.to_crs(epsg=4326)
+    # hexes are already minimal polygons, so there's nothing to simplify, but full double precision coordinates roughly
+    # double the size of the GeoJSON sent to the browser. 1e-6 degrees is ~0.1m, far below what's visible on the map
+    hexes.geometry = hexes.geometry.set_precision(1e-6)
+    return hexes
+
+
+@st.cache_data
+def get_hex_geometry(hex_ids: tuple[int, ...]) -> dict[str, dict[str, Any]]:
+    "Serialised hex geometry (see to_feature_collection)"
+    return geometry_by_id(get_hexes(hex_ids))
+
+
+def geometry_by_id(gdf: gpd.GeoDataFrame) -> dict[str, dict[str, Any]]:
+    return {feature["id"]: feature["geometry"] for feature in gdf[["geometry"]].__geo_interface__["features"]}
+
+
+def to_feature_collection(gdf: gpd.GeoDataFrame, geometry: dict[str, dict[str, Any]]) -> dict[str, Any]:
+    """
+    Equivalent to gdf.__geo_interface__, but looks up each feature's already serialised geometry by id, so only the
+    properties need converting. Serialising the geometry is by far the most expensive part and it doesn't change
+    when only the display settings do
+    """
+    properties = gdf.drop(columns="geometry")
+    properties = properties.astype(object).where(properties.notna(), None)
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {"id": str(key), "type": "Feature", "properties": props, "geometry": geometry[str(key)]}
+            for key, props in zip(gdf.index, properties.to_dict(orient="records"), strict=True)
+        ],
+    }
+
+
 def get_ordered_counts(counts: pd.DataFrame, month: Month, features: gpd.GeoDataFrame) -> pd.DataFrame:
-    ordered_counts = pd.concat([counts.sum(axis=1).rename("n_crimes"), features.area_km2], axis=1)
-    ordered_counts["density"] = ordered_counts.n_crimes / ordered_counts.area_km2
-    ordered_counts = ordered_counts.sort_values(by="density", ascending=False)
+    # work on plain arrays aligned to the features, rather than aligning and sorting frames
+    n_crimes = pd.Series(counts.to_numpy().sum(axis=1), index=counts.index).reindex(features.index, fill_value=0)
+    n_crimes = n_crimes.to_numpy()
+    area_km2 = features.area_km2.to_numpy()
+    density = n_crimes / area_km2
+    order = np.argsort(-density)
+    ordered_counts = pd.DataFrame(
+        {"n_crimes": n_crimes[order], "area_km2": area_km2[order], "density": density[order]},
+        index=features.index[order],
+    )
     # cum area not including current row
-    ordered_counts["cum_area"] = ordered_counts.area_km2.cumsum().shift(fill_value=0)
+    ordered_counts["cum_area"] = np.cumsum(area_km2[order]) - area_km2[order]
     return ordered_counts
 
 
@@ -160,7 +277,7 @@ def get_ethnicity(raw_population: gpd.GeoDataFrame | None, features: gpd.GeoData
         return pd.DataFrame(index=features.index, data={"n/a": 0})
     ethnicity = (
         get_demographics(raw_population, features)
-        .groupby(["spatial_unit", "C2021_ETH_20_NAME"], observed=True)["count"]
+        .groupby(["spatial_unit", "C2021_ETH_20_NAME"], observed=True, sort=False)["count"]
         .sum()
         .unstack(level="C2021_ETH_20_NAME")
     ).reindex(features.index, fill_value=0)
@@ -168,7 +285,55 @@ def get_ethnicity(raw_population: gpd.GeoDataFrame | None, features: gpd.GeoData
     return ethnicity
 
 
+@st.cache_data
+def get_feature_ethnicity(
+    force: Force, geography: str, category: CrimeType, month: str, lookback: int, demographics: bool
+) -> tuple[pd.DataFrame, pd.Series, pd.DataFrame, pd.Series]:
+    """
+    Ethnicity counts for the features returned by get_counts_and_features, force-wide totals, and each feature's
+    breakdown formatted as percentages, both per column for tables and as a single string for tooltips. None of it
+    depends on the hotspot settings, so it only needs computing once per set of features. Raises FileNotFoundError if
+    demographics are requested but unavailable
+    """
+    features, _ = get_counts_and_features(force, geography, category, month, lookback)
+    raw_population = cache_demographic_data(force) if demographics else None
+    ethnicity = get_ethnicity(raw_population, features)
+    # population shares, zero where there's no population
+    population = ethnicity.to_numpy(dtype=np.float32)
+    totals = population.sum(axis=1, keepdims=True)
+    shares = np.divide(population, totals, out=np.zeros_like(population), where=totals > 0)
+    formatted = pd.DataFrame(format_percentages(shares), index=ethnicity.index, columns=ethnicity.columns)
+    return ethnicity, get_ethnicity_totals(raw_population, force), formatted, breakdown_html(formatted)
+
+
+def breakdown_html(formatted: pd.DataFrame) -> pd.Series:
+    """
+    Each row as one "column: value<br/>..." string, so a tooltip references a single property rather than one per
+    column
+    """
+    labelled = [f"{column}: " + values for column, values in formatted.items()]
+    return labelled[0].str.cat(labelled[1:], sep="<br/>")
+
+
 def date_range(start_month: Month, n_months: int) -> tuple[date, date]:
     start_date = date(start_month.year, start_month.month, 1)
     end_date = start_date + relativedelta(months=n_months, days=-1)
     return start_date, end_date
+
+
+def fill_colours(rgb: tuple[int, int, int], alpha: np.ndarray | pd.Series) -> list[list[int]]:
+    """
+    Per-feature RGBA colours for a pydeck layer, precomputed so the client doesn't have to evaluate an expression
+    for every feature
+    """
+    colours = np.empty((len(alpha), 4), dtype=np.uint8)
+    colours[:, :3] = rgb
+    colours[:, 3] = alpha
+    return colours.tolist()
+
+
+def format_percentages(fractions: np.ndarray) -> np.ndarray:
+    """
+    Format an array of fractions as percentage strings to 1dp, e.g. 0.1234 -> "12.3%"
+    """
+    return np.char.mod("%.1f%%", np.asarray(fractions, dtype=float) * 100)
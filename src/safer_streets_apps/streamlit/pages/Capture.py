@@ -1,5 +1,6 @@
 from typing import cast, get_args
 
+import numpy as np
 import pydeck as pdk
 import streamlit as st
 from safer_streets_core.utils import (
@@ -13,12 +14,17 @@ from safer_streets_apps.streamlit.common import (
     all_months,
     cache_demographic_data,
     date_range,
+    fill_colours,
+    format_percentages,
     geographies,
     get_boundary,
+    get_boundary_geometry,
     get_counts_and_features,
     get_ethnicity,
     get_ethnicity_totals,
+    get_feature_geometry,
     get_ordered_counts,
+    to_feature_collection,
 )
 
 st.set_page_config(layout="wide", page_title="Crime Capture", page_icon="👮")
@@ -44,7 +50,7 @@ def init() -> None:
         st.session_state.demographics = False
 
 
-def main() -> None:
+def main() -> None:  # noqa: C901
     init()
     st.title("Crime Capture Explorer")
 
@@ -87,53 +93,51 @@ its crime and demographics (Hover on the force area boundary for average values.
         "Spatial Unit", geographies.keys(), index=list(geographies.keys()).index(st.session_state.spatial_unit_name)
     )
 
-    # m = folium.Map(location=[53.924, -1.832], zoom_start=16)
+    def display_name(m: Month) -> str:
+        if st.session_state.lookback_window == 1:
+            return str(m)
+        return f"{m - st.session_state.lookback_window + 1} to {m}"
 
-    # # add marker
-    # tooltip = "Tooltip"
-    # folium.Marker(
-    #     [53.9228, -1.8326], popup="?", tooltip=tooltip
-    # ).add_to(m)
+    # batch the slider changes so the data is only reprocessed when the user submits
+    with st.sidebar.form("capture"):
+        st.session_state.area_threshold = st.slider(
+            "Coverage (km²)",
+            1.0,
+            100.0,
+            step=1.0,
+            value=st.session_state.area_threshold,
+            help="Focus on the smallest land area that captures the most crime",
+        )
 
-    # # call to render Folium map in Streamlit
-    # sf.folium_static(m, width=800)
+        st.session_state.lookback_window = st.slider(
+            "Lookback window (months)",
+            min_value=1,
+            max_value=12,
+            value=st.session_state.lookback_window,
+            step=1,
+            help="Number of months of data to aggregate at each step",
+        )
 
-    st.session_state.area_threshold = st.sidebar.slider(
-        "Coverage (km²)",
-        1.0,
-        100.0,
-        step=1.0,
-        value=st.session_state.area_threshold,
-        help="Focus on the smallest land area that captures the most crime",
-    )
+        month_options = all_months[st.session_state.lookback_window :]
+        # a longer lookback may rule out the currently selected month
+        if st.session_state.month not in month_options:
+            st.session_state.month = month_options[0]
+
+        st.session_state.month = st.select_slider(
+            "Month selection",
+            month_options,
+            value=st.session_state.month,
+            format_func=display_name,
+            help="Select month",
+        )
 
-    st.session_state.lookback_window = st.sidebar.slider(
-        "Lookback window (months)",
-        min_value=1,
-        max_value=12,
-        value=st.session_state.lookback_window,
-        step=1,
-        help="Number of months of data to aggregate at each step",
-    )
+        st.form_submit_button("Update")
 
     st.session_state.show_missed = st.sidebar.checkbox(
         "Show areas not captured",
         help="Areas that contain some crimes, but not enough to feature in the 'hot' list",
     )
 
-    def display_name(m: Month) -> str:
-        if st.session_state.lookback_window == 1:
-            return str(m)
-        return f"{m - st.session_state.lookback_window + 1} to {m}"
-
-    st.session_state.month = st.sidebar.select_slider(
-        "Month selection",
-        all_months[st.session_state.lookback_window :],
-        value=st.session_state.month,
-        format_func=display_name,
-        help="Select month",
-    )
-
     st.session_state.demographics = st.sidebar.checkbox(
         "Show feature demographics",
         help="Include a breakdown of the population by ethnicity in each feature, if available. "
@@ -170,40 +174,43 @@ its crime and demographics (Hover on the force area boundary for average values.
 
         with st.spinner("Processing crime data..."):
             ordered_counts = get_ordered_counts(counts, st.session_state.month, features)
+            total_crimes = ordered_counts.n_crimes.to_numpy().sum()
 
             # make boundary work with the tooltip
-            boundary["n_crimes"] = ordered_counts.n_crimes.sum()
+            boundary["n_crimes"] = total_crimes
             boundary["population"] = ethnicity_total.sum()
             # this makes the toolips nice but prevents numerical sorting
-            for eth in ethnicity_total.index:
-                boundary[eth] = f"{ethnicity_total[eth] / ethnicity_total.sum():.1%}"
-            boundary["n_crimes"] = ordered_counts.n_crimes.sum()
+            for eth, pct in zip(
+                ethnicity_total.index,
+                format_percentages(ethnicity_total.to_numpy() / ethnicity_total.sum()),
+                strict=True,
+            ):
+                boundary[eth] = pct
 
             # add tooltip info for the features
             tooltip_info = ethnicity.sum(axis=1).rename("population").to_frame()
-            for colname, values in ethnicity.div(ethnicity.sum(axis=1), axis=0).fillna(0).items():
-                tooltip_info[colname] = values.apply(lambda x: f"{x:.1%}")
+            shares = ethnicity.div(ethnicity.sum(axis=1), axis=0).fillna(0)
+            for colname, pcts in zip(shares.columns, format_percentages(shares.to_numpy()).T, strict=True):
+                tooltip_info[colname] = pcts
             tooltip_info["name"] = ethnicity.index
 
+            # cum_area is monotonic so the coverage cutoffs can be found by binary search
+            cum_area = ordered_counts.cum_area.to_numpy()
+            captured = ordered_counts.iloc[: np.searchsorted(cum_area, st.session_state.area_threshold, side="left")]
             # deal with case where we've captured all incidents in a smaller area than specified
-            captured_features = features[["geometry"]].join(
-                ordered_counts[
-                    (ordered_counts.cum_area < st.session_state.area_threshold) & (ordered_counts.n_crimes > 0)
-                ],
-                how="right",
-            )
+            captured_features = features[["geometry"]].join(captured[captured.n_crimes > 0], how="right")
             captured_features = captured_features.join(tooltip_info)
-            captured_features["opacity"] = 192 * captured_features.n_crimes / captured_features.n_crimes.max()
+            captured_features["fill_colour"] = fill_colours(
+                (201, 241, 0), 192 * captured_features.n_crimes / captured_features.n_crimes.max()
+            )
 
             if st.session_state.show_missed:
-                missed_features = features[["geometry"]].join(
-                    ordered_counts[
-                        (ordered_counts.cum_area > st.session_state.area_threshold) & (ordered_counts.n_crimes > 0)
-                    ],
-                    how="right",
-                )
+                missed = ordered_counts.iloc[np.searchsorted(cum_area, st.session_state.area_threshold, side="right") :]
+                missed_features = features[["geometry"]].join(missed[missed.n_crimes > 0], how="right")
                 missed_features = missed_features.join(tooltip_info)
-                missed_features["opacity"] = 96 * missed_features.n_crimes / missed_features.n_crimes.max()
+                missed_features["fill_colour"] = fill_colours(
+                    (0, 63, 245), 96 * missed_features.n_crimes / missed_features.n_crimes.max()
+                )
 
         # render map
         view_state = pdk.ViewState(
@@ -213,9 +220,17 @@ its crime and demographics (Hover on the force area boundary for average values.
             pitch=30,
         )
 
+        feature_geometry = get_feature_geometry(
+            st.session_state.force,
+            st.session_state.spatial_unit_name,
+            st.session_state.category,
+            str(st.session_state.month),
+            st.session_state.lookback_window,
+        )
+
         boundary_layer = pdk.Layer(
             "GeoJsonLayer",
-            boundary.__geo_interface__,
+            to_feature_collection(boundary, get_boundary_geometry(st.session_state.force)),
             opacity=0.5,
             stroked=True,
             filled=False,
@@ -228,11 +243,11 @@ its crime and demographics (Hover on the force area boundary for average values.
         hotspots = (
             pdk.Layer(
                 "GeoJsonLayer",
-                captured_features.__geo_interface__,
+                to_feature_collection(captured_features, feature_geometry),
                 stroked=True,
                 filled=True,
                 wireframe=True,
-                get_fill_color="[201, 241, 0, properties.opacity]",  # [255, 0, 0, 160],
+                get_fill_color="properties.fill_colour",
                 get_line_color=[0xC9, 0xF1, 0x00, 0xA0],
                 line_width_min_pixels=3,
                 pickable=True,
@@ -246,11 +261,11 @@ its crime and demographics (Hover on the force area boundary for average values.
                 1,
                 pdk.Layer(
                     "GeoJsonLayer",
-                    missed_features.__geo_interface__,
+                    to_feature_collection(missed_features, feature_geometry),
                     stroked=True,
                     filled=True,
                     wireframe=True,
-                    get_fill_color="[0, 63, 245, properties.opacity]",  # [255, 0, 0, 160],
+                    get_fill_color="properties.fill_colour",
                     get_line_color=[0x00, 0x39, 0xF5, 0x50],
                     line_width_min_pixels=3,
                     pickable=True,
@@ -260,14 +275,16 @@ its crime and demographics (Hover on the force area boundary for average values.
         start, end = date_range(
             st.session_state.month - st.session_state.lookback_window + 1, st.session_state.lookback_window
         )
+        captured_crimes = captured_features.n_crimes.to_numpy().sum()
+        captured_area = captured_features.area_km2.to_numpy().sum()
         st.markdown(f"""
             ### {st.session_state.category} in {st.session_state.force} PFA
-            - **{ordered_counts.n_crimes.sum()} incidents occurred between {start} and {end} inclusive**
+            - **{total_crimes} incidents occurred between {start} and {end} inclusive**
             - **{len(captured_features)} features ({st.session_state.spatial_unit_name}) covering
-            {captured_features.area_km2.sum():.1f}km² meet the required coverage of {st.session_state.area_threshold}km²**
-            - **{captured_features.n_crimes.sum()} crimes
-            ({captured_features.n_crimes.sum() / ordered_counts.n_crimes.sum():.1%}) are captured in these features,
-            which comprise {captured_features.area_km2.sum() / total_area:.2%} of the PFA ({total_area:.1f}km²)**
+            {captured_area:.1f}km² meet the required coverage of {st.session_state.area_threshold}km²**
+            - **{captured_crimes} crimes
+            ({captured_crimes / total_crimes:.1%}) are captured in these features,
+            which comprise {captured_area / total_area:.2%} of the PFA ({total_area:.1f}km²)**
             """)
 
         tooltip = {
@@ -284,7 +301,7 @@ its crime and demographics (Hover on the force area boundary for average values.
         with st.expander("Hotspot Table"):
             st.dataframe(boundary.drop(columns="geometry"))  # .style.format("{:.1%}", subset=ethnicity.columns))
             st.dataframe(
-                captured_features.drop(columns=["geometry", "cum_area", "name", "opacity"]).sort_values(
+                captured_features.drop(columns=["geometry", "cum_area", "name", "fill_colour"]).sort_values(
                     by="n_crimes", ascending=False
                 )
             )
@@ -1,18 +1,22 @@
 from typing import cast, get_args
 
-import pandas as pd
+import numpy as np
 import pydeck as pdk
 import streamlit as st
 from safer_streets_core.utils import CATEGORIES, DEFAULT_FORCE, Force, latest_month
 
 from safer_streets_apps.streamlit.common import (
-    cache_demographic_data,
+    breakdown_html,
     date_range,
+    fill_colours,
+    format_percentages,
     geographies,
     get_boundary,
+    get_boundary_geometry,
     get_counts_and_features,
-    get_ethnicity,
-    get_ethnicity_totals,
+    get_feature_ethnicity,
+    get_feature_geometry,
+    to_feature_collection,
 )
 
 st.set_page_config(layout="wide", page_title="Crime Capture", page_icon="👮")
@@ -36,6 +40,38 @@ def init() -> None:
         st.session_state.demographics = False
 
 
+def _compute_hits(mean_counts: np.ndarray, area: np.ndarray, area_threshold: float) -> np.ndarray:
+    """
+    Number of windows (columns of mean_counts) in which each feature is one of the densest features that together
+    fit within area_threshold. Features with no crime in a window never count as a hit.
+    """
+    # rank features by density within each window, then accumulate the area of the denser features
+    order = np.argsort(-mean_counts / area[:, None], axis=0)
+    ordered_area = area[order]
+    cum_area = np.zeros_like(ordered_area)
+    np.cumsum(ordered_area[:-1], axis=0, out=cum_area[1:])
+    hits = np.zeros(mean_counts.shape, dtype=bool)
+    np.put_along_axis(
+        hits, order, (cum_area < area_threshold) & (np.take_along_axis(mean_counts, order, axis=0) > 0), axis=0
+    )
+    return hits.sum(axis=1)
+
+
+@st.cache_data
+def _cache_hit_counts(
+    monthly_counts: np.ndarray, area: np.ndarray, area_threshold: float, lookback_window: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Hit counts and the sum of the rolling mean counts for each feature. Cached so that reruns which don't change the
+    data or the coverage/lookback settings skip the computation
+    """
+    # mean counts for every rolling window at once, from differences of the cumulative sum over months
+    cumulative = np.zeros((monthly_counts.shape[0], monthly_counts.shape[1] + 1), dtype=monthly_counts.dtype)
+    np.cumsum(monthly_counts, axis=1, out=cumulative[:, 1:])
+    mean_counts = (cumulative[:, lookback_window:] - cumulative[:, :-lookback_window]) / lookback_window
+    return _compute_hits(mean_counts, area, area_threshold), mean_counts.sum(axis=1)
+
+
 def main() -> None:
     init()
     st.title("Crime Consistency Explorer")
@@ -120,17 +156,21 @@ the hotspots - that is, the set of areas that capture the most crime for the tot
                 st.session_state.observation_period * 12,
             )
 
-        if st.session_state.demographics:
-            with st.spinner("Loading demographic data..."):
-                try:
-                    raw_population = cache_demographic_data(st.session_state.force)
-                except FileNotFoundError as e:
-                    st.warning(e)
-                    raw_population = None
-        else:
-            raw_population = None
-        ethnicity = get_ethnicity(raw_population, features)
-        ethnicity_total = get_ethnicity_totals(raw_population, st.session_state.force)
+        with st.spinner("Loading demographic data..."):
+            feature_args = (
+                st.session_state.force,
+                st.session_state.spatial_unit_name,
+                st.session_state.category,
+                str(latest_month()),
+                st.session_state.observation_period * 12,
+            )
+            try:
+                ethnicity, ethnicity_total, ethnicity_pct, ethnicity_html = get_feature_ethnicity(
+                    *feature_args, st.session_state.demographics
+                )
+            except FileNotFoundError as e:
+                st.warning(e)
+                ethnicity, ethnicity_total, ethnicity_pct, ethnicity_html = get_feature_ethnicity(*feature_args, False)
 
         # process data
         with st.spinner("Processing crime data..."):
@@ -139,43 +179,36 @@ the hotspots - that is, the set of areas that capture the most crime for the tot
             boundary["population"] = ethnicity_total.sum()
             boundary["crime_rate"] = f"{12 * counts.sum().mean():.1f}"
             # this makes the toolips nice but prevents numerical sorting
-            for eth in ethnicity_total.index:
-                boundary[eth] = f"{ethnicity_total[eth] / ethnicity_total.sum():.1%}"
+            for eth, pct in zip(
+                ethnicity_total.index,
+                format_percentages(ethnicity_total.to_numpy() / ethnicity_total.sum()),
+                strict=True,
+            ):
+                boundary[eth] = pct
+            boundary["ethnicity_html"] = breakdown_html(boundary[ethnicity_total.index])
 
             hit_count = features[["geometry"]].copy()
             hit_count["name"] = hit_count.index
             hit_count["population"] = ethnicity.sum(axis=1)
             hit_count = hit_count.join(features.area_km2)
-            hit_count["count"] = 0
-            hit_count["crime_rate"] = 0
 
             # maximum number of times area can feature
             max_hits = 12 * st.session_state.observation_period + 1 - st.session_state.lookback_window
 
-            for c in counts.T.rolling(st.session_state.lookback_window):
-                if len(c) < st.session_state.lookback_window:
-                    continue
-
-                mean_count = c.mean().rename("mean")
-                hit_count["crime_rate"] += mean_count
+            # work on plain single-precision arrays with rows in the same order as features
+            monthly_counts = counts.reindex(features.index, fill_value=0).to_numpy(dtype=np.float32)
+            area = features.area_km2.to_numpy(dtype=np.float32)
 
-                mean_count_by_density = pd.concat(
-                    [mean_count, features.area_km2, (mean_count / features.area_km2).rename("density")], axis=1
-                ).sort_values(by="density", ascending=False)
-                mean_count_by_density["cum_area"] = mean_count_by_density.area_km2.cumsum().shift(fill_value=0)
-
-                hit = (mean_count_by_density.cum_area < st.session_state.area_threshold) & (
-                    mean_count_by_density["mean"] > 0
-                )
-                hit_count["count"] += hit
+            hit_count["count"], hit_count["crime_rate"] = _cache_hit_counts(
+                monthly_counts, area, st.session_state.area_threshold, st.session_state.lookback_window
+            )
 
             # annualised crime rate
             hit_count.crime_rate *= 12 / max_hits
             hit_count = hit_count[hit_count["count"] > 0]
-            hit_count["opacity"] = 192 * hit_count["count"] / max_hits
+            hit_count["fill_colour"] = fill_colours((201, 241, 0), 192 * hit_count["count"] / max_hits)
 
-            for colname, values in ethnicity.div(ethnicity.sum(axis=1), axis=0).fillna(0).items():
-                hit_count[colname] = values.apply(lambda x: f"{x:.1%}")
+            hit_count["ethnicity_html"] = ethnicity_html
 
             hit_count.crime_rate = hit_count.crime_rate.map(lambda r: f"{r:.1f}")
 
@@ -187,9 +220,17 @@ the hotspots - that is, the set of areas that capture the most crime for the tot
             pitch=30,
         )
 
+        feature_geometry = get_feature_geometry(
+            st.session_state.force,
+            st.session_state.spatial_unit_name,
+            st.session_state.category,
+            str(latest_month()),
+            st.session_state.observation_period * 12,
+        )
+
         boundary_layer = pdk.Layer(
             "GeoJsonLayer",
-            boundary.__geo_interface__,
+            to_feature_collection(boundary, get_boundary_geometry(st.session_state.force)),
             opacity=0.5,
             stroked=True,
             filled=False,
@@ -202,11 +243,11 @@ the hotspots - that is, the set of areas that capture the most crime for the tot
         hotspots = (
             pdk.Layer(
                 "GeoJsonLayer",
-                hit_count.__geo_interface__,
+                to_feature_collection(hit_count, feature_geometry),
                 stroked=True,
                 filled=True,
                 wireframe=True,
-                get_fill_color="[201, 241, 0, properties.opacity]",  # [255, 0, 0, 160],
+                get_fill_color="properties.fill_colour",
                 get_line_color=[0xC9, 0xF1, 0x00, 0xA0],
                 line_width_min_pixels=3,
                 pickable=True,
@@ -230,7 +271,7 @@ the hotspots - that is, the set of areas that capture the most crime for the tot
         tooltip = {
             "html": f"Feature {{name}} population: {{population}}<br/>Annual crime rate {{crime_rate}}<br/>"
             f"Hotspot {{count}} times out of {max_hits} <br/>"
-            "Ethnicity breakdown (2021 census):<br/>" + "<br/>".join(f"{eth}: {{{eth}}}" for eth in ethnicity.columns)
+            "Ethnicity breakdown (2021 census):<br/>{ethnicity_html}"
         }
 
         st.pydeck_chart(
@@ -239,11 +280,11 @@ the hotspots - that is, the set of areas that capture the most crime for the tot
         )
 
         with st.expander("Hotspot Table"):
-            st.dataframe(boundary.drop(columns="geometry"))  # .style.format("{:.1%}", subset=ethnicity.columns))
+            st.dataframe(boundary.drop(columns=["geometry", "ethnicity_html"]))
             st.dataframe(
-                hit_count.drop(columns=["geometry", "name", "opacity"]).sort_values(
-                    by=["count", "crime_rate"], ascending=False
-                )
+                hit_count.drop(columns=["geometry", "name", "fill_colour", "ethnicity_html"])
+                .join(ethnicity_pct)
+                .sort_values(by=["count", "crime_rate"], ascending=False)
             )
 
     except Exception as e:
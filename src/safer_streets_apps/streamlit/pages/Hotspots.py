@@ -1,15 +1,24 @@
-from typing import cast, get_args
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, cast, get_args
 
+import numpy as np
 import pandas as pd
 import pydeck as pdk
 import streamlit as st
 from dotenv import load_dotenv
 from itrx import Itr
-from safer_streets_core.api_helpers import fetch_df, fetch_gdf, get
+from safer_streets_core.api_helpers import fetch_df, get
 from safer_streets_core.charts import DEFAULT_COLOUR
 from safer_streets_core.utils import DEFAULT_FORCE, CrimeType, Force, monthgen
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
-from safer_streets_apps.streamlit.common import get_oac, latest_month
+from safer_streets_apps.streamlit.common import (
+    get_hex_geometry,
+    get_hexes,
+    get_oac,
+    latest_month,
+    to_feature_collection,
+)
 
 st.set_page_config(layout="wide", page_title="Crime Hotspots", page_icon="👮")
 st.logo("./assets/safer-streets-small.png", size="large")
@@ -24,19 +33,99 @@ N_MONTHS = 36
 HEX_AREA = 0.2**2 * 3**1.5 / 2
 
 
-def _make_label(timeslice: tuple[str]):
-    return timeslice[0] if len(timeslice) == 1 else f"{timeslice[0]} to {timeslice[-1]}"
+def _make_label(months: list[str], start: int, end: int) -> str:
+    return months[start] if end - start == 1 else f"{months[start]} to {months[end - 1]}"
 
 
 @st.cache_data
-def get_counts(force: Force, crime_type: CrimeType) -> pd.DataFrame:
+def get_counts(force: Force, crime_type: CrimeType) -> tuple[np.ndarray, list[str], pd.Index]:
+    """
+    Monthly hex counts as a dense (hex, month) array covering the last N_MONTHS months, the months of the columns, and
+    the hex ids of the rows
+    """
+    all_months = [str(m) for m in Itr(monthgen(latest_month(), backwards=True)).take(N_MONTHS).rev()]
+    # the API pivots to one column per month server-side, in no particular row order, so sort by hex id (as unstacking
+    # did) to give the hotspot ranking a deterministic tie-break
     counts = (
-        fetch_df("hex_counts", params={"force": force, "category": crime_type})
-        .set_index(["spatial_unit", "month"])
-        .unstack(level="month", fill_value=0)
+        fetch_df(
+            "hex_counts_wide",
+            params={"force": force, "category": crime_type, "month": all_months[-1], "lookback": N_MONTHS},
+        )
+        .set_index("spatial_unit")
+        .sort_index()
+    )
+    # the API returns a column for each month requested, so one we didn't ask for means the labels don't match and
+    # reindexing would silently zero everything
+    unexpected = counts.columns.difference(all_months)
+    if not unexpected.empty:
+        raise ValueError(f"hex_counts_wide returned unexpected months: {', '.join(map(str, unexpected))}")
+    counts = counts.reindex(columns=all_months, fill_value=0)
+    # monthly counts per hex are small, so int16 is plenty and halves the size of the array the window sums scan
+    # (the cumulative sums are taken in int64)
+    return counts.to_numpy(dtype=np.int16), all_months, counts.index
+
+
+@st.cache_data
+def get_pfa_geodata(force: Force) -> dict[str, Any]:
+    "PFA boundary as a GeoJSON feature, with its area and centroid in the properties. Static, so fetched once per force"
+    return get("pfa_geodata", params={"force": force})
+
+
+@st.cache_data
+def get_hotspot_counts(
+    force: Force, crime_type: CrimeType, n_hotspots: int, window: int, prediction_window: int, update: int
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Proportions captured/predicted by the hotspots in each window of the timeline, and the number of windows in which
+    each hex is a hotspot. The sliders only take a handful of values, so after a few interactions most settings are
+    served straight from the cache
+    """
+    counts, months, hex_ids = get_counts(force, crime_type)
+
+    # column positions of the windows in the timeline: window i covers months [starts[i], ends[i]) and is followed by
+    # the prediction window [ends[i], pred_ends[i]), where the data extends that far
+    starts = np.arange(0, N_MONTHS - window + 1, update)
+    ends = starts + window
+    pred_ends = ends + prediction_window
+    has_prediction = pred_ends <= N_MONTHS
+
+    # window sums are differences of the cumulative sum over months, giving a (hex, window) matrix in one go
+    cum_counts = np.zeros((len(counts), N_MONTHS + 1), dtype=np.int64)
+    np.cumsum(counts, axis=1, out=cum_counts[:, 1:])
+    window_counts = cum_counts[:, ends] - cum_counts[:, starts]
+
+    # top-k selection only needs a partition of each window's sums to find the k-th largest, not a full sort. Every
+    # hex above it is a hotspot, and the remaining places go to the hexes equal to it in hex id (row) order, so ties at
+    # the cut-off are deterministic
+    n_top = min(n_hotspots, len(counts))
+    kth = -np.partition(-window_counts, n_top - 1, axis=0)[n_top - 1]
+    above = window_counts > kth
+    tied = window_counts == kth
+    hotspots = above | (tied & (np.cumsum(tied, axis=0) <= n_top - above.sum(axis=0)))
+    captured = 100 * np.where(hotspots, window_counts, 0).sum(axis=0) / window_counts.sum(axis=0)
+
+    # proportion of crime in each subsequent prediction window that falls in the hotspots, where there is one
+    predicted = np.full(len(starts), np.nan)
+    if has_prediction.any():
+        pred_counts = cum_counts[:, pred_ends[has_prediction]] - cum_counts[:, ends[has_prediction]]
+        predicted[has_prediction] = (
+            100 * np.where(hotspots[:, has_prediction], pred_counts, 0).sum(axis=0) / pred_counts.sum(axis=0)
+        )
+
+    props = pd.DataFrame(
+        {
+            "Time slice": [
+                _make_label(months, start, end) + (f" predicting {_make_label(months, end, pred_end)}" if pred else "")
+                for start, end, pred_end, pred in zip(starts, ends, pred_ends, has_prediction, strict=True)
+            ],
+            "Proportion in hotspots": captured,
+            "Proportion predicted by hotspots": predicted,
+        }
     )
-    counts.columns = counts.columns.droplevel(0)
-    return counts
+    # count hotspot appearances by row position, then keep only the hexes that appear at all
+    hotspot_counts = hotspots.sum(axis=1)
+    (is_hotspot,) = hotspot_counts.nonzero()
+    return props, pd.DataFrame({"count": hotspot_counts[is_hotspot]}, index=hex_ids[is_hotspot])
 
 
 def main() -> None:
@@ -112,63 +201,34 @@ The interactive map displays the hotspot hex cells shaded in proportion to their
 
     try:
         with st.spinner("Loading crime data..."):
-            counts = get_counts(force, crime_type)
+            # these don't depend on each other and are IO bound, so fetch them concurrently. The workers need the
+            # script context for the cached functions to work outside the main thread
+            with ThreadPoolExecutor(
+                max_workers=3, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())
+            ) as executor:
+                counts_future = executor.submit(get_counts, force, crime_type)
+                pfa_geodata_future = executor.submit(get_pfa_geodata, force)
+                oac_future = executor.submit(get_oac)
+            # deliberately discarded: this only warms get_counts' cache, which get_hotspot_counts reads from, so the
+            # fetch overlaps the others. Passing the array in instead would have it hashed for every cache lookup
+            counts_future.result()
+            pfa_geodata = pfa_geodata_future.result()
+            hex_oa_mapping, oac = oac_future.result()
 
         with st.spinner("Processing data..."):
-            timeline = (
-                Itr(monthgen(latest_month(), backwards=True)).take(N_MONTHS).rev().rolling(window).step_by(update)
-            )
-
-            # subsequent prediction_window months for each window in timeline, padded where data isnt available
-            # prediction_timeline = Itr(monthgen(timeline.peek()[-1] + 1)).take(N_MONTHS - window).rolling(prediction_window).step_by(update)
-            prediction_timeline = (
-                Itr(monthgen(timeline.peek()[-1] + 1))
-                .take(N_MONTHS - window)
-                .rolling(prediction_window)
-                .step_by(update)
-                .chain([None] * prediction_window)
-            )
-
-            hex_oa_mapping, oac_codes, oac_desc = get_oac()
-
-            pfa_geodata = get("pfa_geodata", params={"force": force})
             hotspot_area = coverage * pfa_geodata["properties"]["area"] / 100
             n_hotspots = max(1, int(hotspot_area / HEX_AREA))
 
-            props = pd.DataFrame(columns=["Time slice", "Proportion in hotspots", "Proportion predicted by hotspots"])
-            temp = []
-            for i, (slice, prediction_slice) in timeline.zip(prediction_timeline).enumerate():
-                months = [str(m) for m in slice]
-                ranked = counts[months].sum(axis=1).sort_values(ascending=False)
-                hotspots = ranked.head(n_hotspots)
-                props.loc[i, "Time slice"] = _make_label(months)
-                props.loc[i, "Proportion in hotspots"] = 100 * hotspots.sum() / ranked.sum()
-
-                if prediction_slice:
-                    pred_months = [str(m) for m in prediction_slice]
-                    pred_counts = counts[pred_months].sum(axis=1)
-                    # pred_props[_make_label(pred_months)] = 100 * pred_counts.loc[hotspots.index].sum() / pred_counts.sum()
-                    props.loc[i, "Time slice"] += " predicting " + _make_label(pred_months)
-                    props.loc[i, "Proportion predicted by hotspots"] = (
-                        100 * pred_counts.loc[hotspots.index].sum() / pred_counts.sum()
-                    )
-                temp.append(ranked.head(n_hotspots).reset_index().spatial_unit)
+            props, ranks = get_hotspot_counts(force, crime_type, n_hotspots, window, prediction_window, update)
 
             # map hexes to OAs and add OA classifications
-            ranks = pd.concat(temp).value_counts().to_frame().join(hex_oa_mapping)
-            ranks = ranks.merge(oac_codes, left_on="OA21CD", right_index=True)
-            ranks = ranks.merge(oac_desc.rename("Supergroup"), left_on="supergroup_code", right_index=True)
-            ranks = ranks.merge(oac_desc.rename("Group"), left_on="group_code", right_index=True)
-            ranks = ranks.merge(oac_desc.rename("Subgroup"), left_on="subgroup_code", right_index=True)
+            ranks = ranks.join(hex_oa_mapping).merge(oac, left_on="OA21CD", right_index=True)
 
         with st.spinner("Loading spatial data..."):
-            hexes = fetch_gdf("hexes", ranks.index.to_list(), http_post=True).set_index("id")
-            # TODO annoyingly comes back with a string index, can this be fixed?
-            hexes.index = hexes.index.astype(int)
-            # TODO also return in CRS we need for pydeck? Low priority - join/transform below takes ~20ms
-            hexes = hexes.join(ranks).to_crs(epsg=4326)
+            hex_ids = tuple(sorted(ranks.index.to_list()))
+            hexes = get_hexes(hex_ids).join(ranks)
             n_obs = (N_MONTHS - window) // update + 1
-            hexes["Frequency (%)"] = round(100.0 * hexes["count"] / n_obs, 1)
+            hexes["Frequency (%)"] = np.round(100.0 * hexes["count"].to_numpy() / n_obs, 1)
 
         st.markdown(
             f"### Hotspot repetition, {crime_type} in {force}, {latest_month() - N_MONTHS + 1} to {latest_month()}"
@@ -197,7 +257,11 @@ The interactive map displays the hotspot hex cells shaded in proportion to their
         hotspot_layer = (
             pdk.Layer(
                 "GeoJsonLayer",
-                hexes.__geo_interface__,
+                # only send the properties the tooltip and colouring use
+                to_feature_collection(
+                    hexes[["geometry", "count", "Frequency (%)", "OA21CD", "Supergroup", "Group", "Subgroup"]],
+                    get_hex_geometry(hex_ids),
+                ),
                 stroked=True,
                 filled=True,
                 wireframe=True,
@@ -235,7 +299,7 @@ The interactive map displays the hotspot hex cells shaded in proportion to their
         with st.expander("Output Area classfication rankings"):
             levels = ["Supergroup", "Group", "Subgroup"]
             level = st.select_slider("OAC Level", levels, value="Group")
-            st.dataframe(ranks[levels[: levels.index(level) + 1]].value_counts().sort_values(ascending=False))
+            st.dataframe(ranks[levels[: levels.index(level) + 1]].value_counts())
 
         st.markdown(
             f"#### Time variation of percentage of crimes captured and predicted within the {coverage:.1f}% hotspot coverage:"
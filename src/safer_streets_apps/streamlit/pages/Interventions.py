@@ -5,23 +5,35 @@ import geopandas as gpd
 import pandas as pd
 import pydeck as pdk
 import streamlit as st
+import streamlit.components.v1 as components
 from dotenv import load_dotenv
-from itrx import Itr
-from safer_streets_core.api_helpers import fetch_gdf
-from safer_streets_core.utils import CATEGORIES, Force, Month, data_dir, fix_force_name, monthgen
-
-from safer_streets_apps.streamlit.common import date_range, get_oac, latest_month
+from safer_streets_core.utils import CATEGORIES, Force, Month, data_dir, fix_force_name
+
+from safer_streets_apps.streamlit.common import (
+    date_range,
+    get_hex_geometry,
+    get_hexes,
+    get_oac,
+    latest_month,
+    to_feature_collection,
+)
 
 st.set_page_config(layout="wide", page_title="Crime Hotspots", page_icon="👮")
 st.logo("./assets/safer-streets-small.png", size="large")
 
 load_dotenv()
 
-FORCES = tuple(
-    fix_force_name(f)  # name only used to query boundary
-    for f in get_args(Force)
-    if f not in ["BTP", "Greater Manchester", "Northern Ireland", "Gwent"]
-)
+
+@st.cache_resource
+def _forces() -> tuple[str, ...]:
+    return tuple(
+        fix_force_name(f)  # name only used to query boundary
+        for f in get_args(Force)
+        if f not in ["BTP", "Greater Manchester", "Northern Ireland", "Gwent"]
+    )
+
+
+FORCES = _forces()
 
 Constraint = Literal["National", "Equal", "Size"]
 
@@ -40,11 +52,24 @@ REF_LON = -2.0
 def get_counts(constraint: Constraint) -> pd.DataFrame:
     match constraint:
         case "National":
-            return pd.read_parquet(data_dir() / f"national_hotspots_{latest_month()}.parquet")
+            counts = pd.read_parquet(data_dir() / f"national_hotspots_{latest_month()}.parquet")
         case "Equal":
-            return pd.read_parquet(data_dir() / f"force_hotspots_{latest_month()}.parquet")
+            counts = pd.read_parquet(data_dir() / f"force_hotspots_{latest_month()}.parquet")
         case "Size":
-            return pd.read_parquet(data_dir() / f"headcount_hotspots_{latest_month()}.parquet")
+            counts = pd.read_parquet(data_dir() / f"headcount_hotspots_{latest_month()}.parquet")
+    # sorted so that selecting on the leading levels is a binary search rather than a scan
+    return counts.sort_index()
+
+
+@st.cache_data
+def get_count_data(
+    constraint: Constraint, lookback: int, ref_date: str, lookforward: int, hotspots: int, crime_type: str
+) -> pd.DataFrame:
+    """
+    Hotspot counts for a single combination of settings. Cached so that a rerun with settings seen before doesn't need
+    a copy of the whole table from get_counts
+    """
+    return get_counts(constraint).loc[(lookback, ref_date, lookforward, hotspots, crime_type)]
 
 
 # @st.cache_data
@@ -57,12 +82,19 @@ def get_counts(constraint: Constraint) -> pd.DataFrame:
 #     return pd.read_parquet(data_dir() / f"force_hotspots_{latest_month()}.parquet")
 
 
-@st.cache_data
+# cache_resource rather than cache_data: the GeoJSON is only ever read, so every session can share the same dicts
+# rather than unpickling a fresh copy of every boundary on each rerun
+@st.cache_resource
 def simplified_pfa_boundaries() -> tuple[dict[str, Any], dict[str, Any]]:
-    force_boundaries = gpd.read_file(data_dir() / "Police_Force_Areas_December_2023_EW_BFE_2734900428741300179.zip")
+    # only the name is needed, so don't read the other attribute columns
+    force_boundaries = gpd.read_file(
+        data_dir() / "Police_Force_Areas_December_2023_EW_BFE_2734900428741300179.zip", columns=["PFA23NM"]
+    )
     # this should be significantly smaller than a hex (although its not used in a spatial join)
     force_boundaries.geometry = force_boundaries.simplify(tolerance=50)
     force_boundaries = force_boundaries.to_crs(epsg=4326)
+    # ~0.1m, plenty for display, and it roughly halves the size of the GeoJSON
+    force_boundaries.geometry = force_boundaries.geometry.set_precision(1e-6)
 
     return (
         force_boundaries[force_boundaries.PFA23NM.isin(FORCES)][["PFA23NM", "geometry"]].__geo_interface__,
@@ -70,7 +102,14 @@ def simplified_pfa_boundaries() -> tuple[dict[str, Any], dict[str, Any]]:
     )
 
 
-MONTHS = Itr(monthgen(latest_month(), backwards=True)).take(N_MONTHS).rev().map(str).collect()
+@st.cache_resource
+def _months() -> list[str]:
+    "The last N_MONTHS months, oldest first, computed once per process rather than on every rerun"
+    latest = latest_month()
+    return [str(latest - i) for i in range(N_MONTHS - 1, -1, -1)]
+
+
+MONTHS = _months()
 
 
 def main() -> None:
@@ -184,31 +223,19 @@ incomplete or missing data.
 
     try:
         with st.spinner("Loading crime data..."):
-            # count_data = (get_force_counts() if st.session_state.constrain else get_national_counts()).loc[
-            count_data = get_counts(st.session_state.constraint).loc[
-                (
-                    st.session_state.lookback,
-                    st.session_state.ref_date,
-                    st.session_state.lookforward,
-                    st.session_state.hotspots,
-                    crime_type,
-                )
-            ]
-
-            hex_oa_mapping, oac_codes, oac_desc = get_oac()
-
-        hexes = fetch_gdf(
-            "hexes", count_data.index.get_level_values("spatial_unit").tolist(), http_post=True
-        ).set_index("id")
-        # TODO annoyingly comes back with a string index, can this be fixed?
-        hexes.index = hexes.index.astype(int)
-        hexes = hexes.to_crs(epsg=4326)
-
-        hexes = hexes.join(hex_oa_mapping)
-        hexes = hexes.merge(oac_codes, left_on="OA21CD", right_index=True)
-        hexes = hexes.merge(oac_desc.rename("Supergroup"), left_on="supergroup_code", right_index=True)
-        hexes = hexes.merge(oac_desc.rename("Group"), left_on="group_code", right_index=True)
-        hexes = hexes.merge(oac_desc.rename("Subgroup"), left_on="subgroup_code", right_index=True)
+            count_data = get_count_data(
+                st.session_state.constraint,
+                st.session_state.lookback,
+                st.session_state.ref_date,
+                st.session_state.lookforward,
+                st.session_state.hotspots,
+                crime_type,
+            )
+
+            hex_oa_mapping, oac = get_oac()
+
+        hex_ids = tuple(sorted(count_data.index.get_level_values("spatial_unit").to_list()))
+        hexes = get_hexes(hex_ids).join(hex_oa_mapping).merge(oac, left_on="OA21CD", right_index=True)
 
         active_pfa_boundaries, missing_pfa_boundaries = simplified_pfa_boundaries()
 
@@ -247,7 +274,10 @@ incomplete or missing data.
         hotspot_layer = (
             pdk.Layer(
                 "GeoJsonLayer",
-                hexes.__geo_interface__,
+                # only send the properties the tooltip uses
+                to_feature_collection(
+                    hexes[["geometry", "OA21CD", "Supergroup", "Group", "Subgroup"]], get_hex_geometry(hex_ids)
+                ),
                 stroked=True,
                 filled=True,
                 wireframe=True,
@@ -261,17 +291,17 @@ incomplete or missing data.
 
         tooltip = {"html": "Intersect {OA21CD} classification:<br/>{Supergroup}<br/>{Group}<br/>{Subgroup}"}
 
-        st.pydeck_chart(
-            pdk.Deck(
-                map_style=st.context.theme.type,
-                layers=[boundary_layer, missing_layer, hotspot_layer],
-                initial_view_state=view_state,
-                tooltip=tooltip,
-            ),
-            height=880,
+        deck = pdk.Deck(
+            map_style=st.context.theme.type,
+            layers=[boundary_layer, missing_layer, hotspot_layer],
+            initial_view_state=view_state,
+            tooltip=tooltip,
         )
+        # render as a standalone deck.gl page, which is much more responsive than st.pydeck_chart for this many hexes
+        components.html(deck.to_html(as_string=True), height=880)
 
-        crime_coverage = (count_data.lookforward_total / count_data.lf_national_total).sum()
+        lookforward_total = count_data.lookforward_total.to_numpy()
+        crime_coverage = (lookforward_total / count_data.lf_national_total.to_numpy()).sum()
         ref_date = Month.parse_str(st.session_state.ref_date)
         hotspot_area = HEX_AREA * st.session_state.hotspots * len(FORCES)
         area_coverage = hotspot_area / EW_AREA
@@ -283,7 +313,7 @@ incomplete or missing data.
             - **Hotspots for {crime_type} determined using data from {lb_start} to {lb_end} inclusive**
             - **Crimes occurring in hotspots counted from {lf_start} to {lf_end} inclusive**
             - **{st.session_state.hotspots * len(FORCES)} hex cells ({hotspot_area:.1f}km²) capture {crime_coverage:.3%}
-            of crimes ({count_data.lookforward_total.sum()} offences) in {area_coverage:.3%} of total land area**
+            of crimes ({lookforward_total.sum()} offences) in {area_coverage:.3%} of total land area**
             - **Estimated national reduction from targeted patrol in these hotspots:
             {crime_coverage * st.session_state.patrol_effectiveness:.3f}%**
             - **Estimated national reduction from problem-solving approaches in these hotspots:
@@ -291,12 +321,12 @@ incomplete or missing data.
         """)
 
         with st.expander("Hotspot counts by force"):
-            st.dataframe(count_data.index.get_level_values("Force").value_counts().sort_values(ascending=False))
+            st.dataframe(count_data.index.get_level_values("Force").value_counts())
 
         with st.expander("Hotspot counts by by Output Area classfication"):
             levels = ["Supergroup", "Group", "Subgroup"]
             level = st.select_slider("OAC Level", levels, value="Group")
-            st.dataframe(hexes[levels[: levels.index(level) + 1]].value_counts().sort_values(ascending=False))
+            st.dataframe(hexes[levels[: levels.index(level) + 1]].value_counts())
 
     except Exception as e:
         st.error(e)
@@ -1,34 +1,13 @@
 from time import sleep
-from typing import get_args
+from typing import Any, get_args
 
-import geopandas as gpd
+import numpy as np
 import pandas as pd
 import pydeck as pdk
 import streamlit as st
-from itrx import Itr
-from safer_streets_core.spatial import get_force_boundary, map_to_spatial_unit
-from safer_streets_core.utils import (
-    CATEGORIES,
-    DEFAULT_FORCE,
-    Force,
-    calc_gini,
-    get_monthly_crime_counts,
-    latest_month,
-    load_crime_data,
-    monthgen,
-)
-
-# streamlit seems to break load_dotenv
-LATEST_DATE = latest_month()
-all_months = Itr(monthgen(LATEST_DATE, backwards=True)).take(36).rev().collect()
-
-
-@st.cache_data
-def cache_crime_data(force: Force, category: str) -> tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]:
-    force_boundary = get_force_boundary(force)
-    data = load_crime_data(force, all_months, filters={"Crime type": category}, keep_lonlat=True)
-    return data, force_boundary
+from safer_streets_core.utils import CATEGORIES, DEFAULT_FORCE, Force, calc_gini
 
+from safer_streets_apps.streamlit.common import cache_centroid_and_boundary, cache_counts_and_features
 
 st.set_page_config(layout="wide", page_title="Safer Streets", page_icon="👮")
 
@@ -74,8 +53,6 @@ the set of areas capture the most crime, with red being the highest.
     spatial_unit_name = st.sidebar.selectbox("Spatial Unit", geographies.keys(), index=0)
 
     try:
-        raw_data, boundary = cache_crime_data(force, category)
-
         area_threshold = st.sidebar.slider(
             "Coverage (km²)",
             1.0,
@@ -99,17 +76,9 @@ the set of areas capture the most crime, with red being the highest.
         # )
 
         # map crimes to features
-        centroid_lat, centroid_lon = raw_data.lat.mean(), raw_data.lon.mean()
+        centroid_lat, centroid_lon, boundary_geojson = cache_centroid_and_boundary(force, category)
         spatial_unit, spatial_unit_params = geographies[spatial_unit_name]
-        crime_data, features = map_to_spatial_unit(raw_data, boundary, spatial_unit, **spatial_unit_params)
-        # compute area in sensible units before changing crs!
-        features["area_km2"] = features.area / 1_000_000
-        # now convert everything to Webmercator
-        crime_data = crime_data.to_crs(epsg=4326)
-        boundary = boundary.to_crs(epsg=4326)
-        features = features.to_crs(epsg=4326)
-        # and aggregate
-        counts = get_monthly_crime_counts(crime_data, features)
+        counts, features, _ = cache_counts_and_features(force, category, spatial_unit, **spatial_unit_params)
         num_features = len(features)
         area_threshold = features.area_km2.sum() - area_threshold
         stats = pd.DataFrame(columns=["Gini", "Percent Captured"])
@@ -125,7 +94,7 @@ the set of areas capture the most crime, with red being the highest.
 
         boundary_layer = pdk.Layer(
             "GeoJsonLayer",
-            boundary.__geo_interface__,
+            boundary_geojson,
             opacity=0.5,
             stroked=True,
             filled=False,
@@ -134,7 +103,7 @@ the set of areas capture the most crime, with red being the highest.
             get_line_color=[64, 64, 192, 255],
         )
 
-        def render(month: str, area: float, rankings: gpd.GeoDataFrame) -> None:
+        def render(month: str, area: float, rankings: dict[str, Any]) -> None:
             period = f"{counts.columns[0]} to {month} ({lookback_window} month average)"
 
             title.markdown(f"""
@@ -152,7 +121,7 @@ the set of areas capture the most crime, with red being the highest.
                 boundary_layer,
                 pdk.Layer(
                     "GeoJsonLayer",
-                    rankings.__geo_interface__,
+                    rankings,
                     opacity=1.0,
                     stroked=True,
                     filled=True,
@@ -184,30 +153,52 @@ the set of areas capture the most crime, with red being the highest.
             )
 
         def render_dynamic() -> None:
-            running_total = features[["geometry"]].copy()
-            running_total["count"] = 0
-            running_total["name"] = running_total.index
-
-            for c in counts.T.rolling(lookback_window):
-                if len(c) < lookback_window:
-                    continue
-
-                period = f"{c.index[0]} to {c.index[-1]}" if lookback_window > 1 else c.index[0]
-                mean_count = c.mean().rename("mean")
-
-                mean_count_by_density = pd.concat(
-                    [mean_count, features.area_km2, (mean_count / features.area_km2).rename("density")], axis=1
-                ).sort_values(by="density")
-
-                hit = (mean_count_by_density.area_km2.cumsum() > area_threshold) & (mean_count_by_density["mean"] > 0)
-                running_total["count"] += hit
-
-                stats.loc[period, "Percent Captured"] = (mean_count * hit).sum() / mean_count.sum() * 100
+            # geometry doesn't change during a run, so serialise it once and only update the counts each frame
+            feature_template = features[["geometry"]].__geo_interface__["features"]
+            for feature in feature_template:
+                feature["properties"] = {"name": feature["id"], "count": 0}
+
+            # these don't change between windows
+            area = features.area_km2.to_numpy()
+            inv_area = 1.0 / area
+
+            # one bit per window recording whether each feature was a hotspot (at most 36 windows, so fits in 64 bits)
+            hit_history = np.zeros(num_features, dtype=np.uint64)
+
+            # mean count for every window at once, one column per window. Differencing the cumulative sum is a sliding
+            # sum: each window costs one subtraction however long the lookback is
+            months = counts.columns
+            monthly_counts = counts.reindex(features.index, fill_value=0).to_numpy(dtype=float)
+            cumulative = np.zeros((num_features, len(months) + 1))
+            np.cumsum(monthly_counts, axis=1, out=cumulative[:, 1:])
+            window_means = (cumulative[:, lookback_window:] - cumulative[:, :-lookback_window]) / lookback_window
+
+            for window, mean_count_values in enumerate(window_means.T):
+                first_month, last_month = months[window], months[window + lookback_window - 1]
+                period = f"{first_month} to {last_month}" if lookback_window > 1 else first_month
+                mean_count = pd.Series(mean_count_values, index=features.index)
+
+                # accumulate area from the least to the most crime-dense feature
+                order = np.argsort(mean_count_values * inv_area)
+                hit = np.zeros(num_features, dtype=bool)
+                hit[order] = (np.cumsum(area[order]) > area_threshold) & (mean_count_values[order] > 0)
+                hit_history |= hit.astype(np.uint64) << np.uint64(window)
+                hit_counts = np.bitwise_count(hit_history)
+
+                stats.loc[period, "Percent Captured"] = mean_count_values[hit].sum() / mean_count_values.sum() * 100
                 stats.loc[period, "Features Included"] = hit.sum() / num_features * 100
                 stats.loc[period, "Gini"] = calc_gini(mean_count)[0] * 100
 
+                rankings: list[dict[str, Any]] = []
+                for feature, count in zip(feature_template, hit_counts, strict=True):
+                    if count > 0:
+                        feature["properties"]["count"] = int(count)
+                        rankings.append(feature)
+
                 render(
-                    c.index[-1], (mean_count_by_density.area_km2 * hit).sum(), running_total[running_total["count"] > 0]
+                    last_month,
+                    area[hit].sum(),
+                    {"type": "FeatureCollection", "features": rankings},
                 )
                 sleep(0.1)
 
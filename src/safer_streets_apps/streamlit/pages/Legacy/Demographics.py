@@ -1,35 +1,34 @@
-from typing import get_args
+from typing import Any, get_args
 
 import geopandas as gpd
 import pydeck as pdk
 import streamlit as st
-from itrx import Itr
-from safer_streets_core.spatial import get_demographics, get_force_boundary, load_population_data, map_to_spatial_unit
-from safer_streets_core.utils import (
-    CATEGORIES,
-    DEFAULT_FORCE,
-    Force,
-    get_monthly_crime_counts,
-    latest_month,
-    load_crime_data,
-    monthgen,
+import streamlit.components.v1 as components
+from safer_streets_core.spatial import get_demographics, load_population_data
+from safer_streets_core.utils import CATEGORIES, DEFAULT_FORCE, Force
+
+from safer_streets_apps.streamlit.common import (
+    all_months,
+    cache_centroid_and_boundary,
+    cache_counts_and_features,
+    format_percentages,
+    geometry_by_id,
+    to_feature_collection,
 )
 
-# streamlit seems to break load_dotenv
-LATEST_DATE = latest_month()
-all_months = Itr(monthgen(LATEST_DATE, backwards=True)).take(36).rev().collect()
 
-
-@st.cache_data
-def cache_crime_data(force: Force, category: str) -> tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]:
-    force_boundary = get_force_boundary(force)
-    data = load_crime_data(force, all_months, filters={"Crime type": category}, keep_lonlat=True)
-    return data, force_boundary
+# census data is static, so persist it across restarts to avoid reloading it on a cold start
+@st.cache_data(persist="disk", max_entries=64)
+def cache_population(force: Force) -> gpd.GeoDataFrame:
+    return load_population_data(force).to_crs(epsg=4326)
 
 
 @st.cache_data
-def cache_population(force: Force) -> gpd.GeoDataFrame:
-    return load_population_data(force)
+def cache_feature_geometry(force: Force, category: str, spatial_unit_name: str) -> dict[str, dict[str, Any]]:
+    "Serialised feature geometry (see to_feature_collection)"
+    spatial_unit, spatial_unit_params = geographies[spatial_unit_name]
+    _, features, _ = cache_counts_and_features(force, category, spatial_unit, **spatial_unit_params)
+    return geometry_by_id(features)
 
 
 st.set_page_config(layout="wide", page_title="Safer Streets", page_icon="👮")
@@ -90,21 +89,13 @@ that area, with red being the highest.
     )
 
     try:
-        raw_data, boundary = cache_crime_data(force, category)
-
         # map crimes to features
-        centroid_lat, centroid_lon = raw_data.lat.mean(), raw_data.lon.mean()
+        centroid_lat, centroid_lon, boundary_geojson = cache_centroid_and_boundary(force, category)
         spatial_unit, spatial_unit_params = geographies[spatial_unit_name]
-        crime_data, features = map_to_spatial_unit(raw_data, boundary, spatial_unit, **spatial_unit_params)
-        # compute area in sensible units before changing crs!
-        features["area_km2"] = features.area / 1_000_000
-        # now convert everything to Webmercator
-        crime_data = crime_data.to_crs(epsg=4326)
-        boundary = boundary.to_crs(epsg=4326)
-        features = features.to_crs(epsg=4326)
-        population = cache_population(force).to_crs(epsg=4326)
-        # and aggregate - annualised rate
-        counts = get_monthly_crime_counts(crime_data, features).sum(axis=1) / 3
+        monthly_counts, features, _ = cache_counts_and_features(force, category, spatial_unit, **spatial_unit_params)
+        # annualised rate
+        counts = monthly_counts.sum(axis=1) / 3
+        population = cache_population(force)
 
         ethnicity = (
             get_demographics(population, features)
@@ -120,8 +111,9 @@ that area, with red being the highest.
         ethnicity = ethnicity[ethnicity["count"] > 0]
 
         # round/reformat for tooltips
-        for eth in ethnicities:
-            ethnicity[eth] = ethnicity[eth].map(lambda x: f"{x:.1%}")
+        percentages = format_percentages(ethnicity[list(ethnicities)].to_numpy())
+        for i, eth in enumerate(ethnicities):
+            ethnicity[eth] = percentages[:, i]
         ethnicity["count"] = ethnicity["count"].round(1)
         ethnicity["name"] = ethnicity.index
 
@@ -136,7 +128,7 @@ that area, with red being the highest.
 
         boundary_layer = pdk.Layer(
             "GeoJsonLayer",
-            boundary.__geo_interface__,
+            boundary_geojson,
             opacity=0.5,
             stroked=True,
             filled=False,
@@ -149,7 +141,11 @@ that area, with red being the highest.
             boundary_layer,
             pdk.Layer(
                 "GeoJsonLayer",
-                ethnicity.__geo_interface__,
+                # only send the properties the tooltip and styling use
+                to_feature_collection(
+                    ethnicity[["geometry", "name", "population", "count", *ethnicities]],
+                    cache_feature_geometry(force, category, spatial_unit_name),
+                ),
                 opacity=1.0,
                 stroked=True,
                 filled=True,
@@ -173,10 +169,9 @@ that area, with red being the highest.
             "Ethnicity breakdown (2021 census):<br/>" + "<br/>".join(f"{eth}: {{{eth}}}" for eth in ethnicities)
         }
 
-        st.pydeck_chart(
-            pdk.Deck(map_style=st.context.theme.type, layers=layers, initial_view_state=view_state, tooltip=tooltip),
-            height=960,
-        )
+        deck = pdk.Deck(map_style=st.context.theme.type, layers=layers, initial_view_state=view_state, tooltip=tooltip)
+        # standalone deck.gl page rather than st.pydeck_chart, which is slow to pan/zoom with extruded layers
+        components.html(deck.to_html(as_string=True), height=960)
 
         with st.expander("Table View"):
             st.dataframe(ethnicity.drop("geometry", axis=1))
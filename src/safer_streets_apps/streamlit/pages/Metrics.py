@@ -2,6 +2,7 @@ from typing import cast, get_args
 
 import geopandas as gpd
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import streamlit as st
 from safer_streets_core.charts import make_radar_chart
@@ -12,31 +13,50 @@ from safer_streets_core.measures import (
     rank_biased_overlap,
     spearman_rank_correlation,
 )
-from safer_streets_core.utils import CATEGORIES, DEFAULT_FORCE, Force, Month
-from sklearn.metrics import f1_score
+from safer_streets_core.utils import CATEGORIES, DEFAULT_FORCE, Force
 
 from safer_streets_apps.streamlit.common import (
     all_months,
-    cache_crime_data,
+    cache_counts_and_features,
     cache_demographic_data,
     geographies,
-    get_counts_and_features_old,
     get_ethnicity,
 )
 
 
-def get_windowed_ordered_counts(
-    counts: pd.DataFrame, month: Month, lookback_window: int, features: gpd.GeoDataFrame
-) -> pd.DataFrame:
-    windowed_counts = counts[[str(month - i) for i in range(lookback_window)]]
-    windowed_counts = windowed_counts.sum(axis=1).rename("n_crimes")
-    ordered_counts = pd.concat([windowed_counts, features.area_km2], axis=1)
-    ordered_counts["density"] = ordered_counts.n_crimes / ordered_counts.area_km2
-    ordered_counts = ordered_counts.sort_values(by="density")
-    ordered_counts["cum_area"] = ordered_counts.area_km2.cumsum()
+def get_window_counts(counts: pd.DataFrame, lookback_window: int) -> np.ndarray:
+    """
+    Crime counts for every lookback window at once, from differences of the cumulative sum over months. Column i is
+    the window ending at column i + lookback_window - 1 of counts
+    """
+    cumulative = np.zeros((counts.shape[0], counts.shape[1] + 1), dtype=np.int64)
+    np.cumsum(counts.to_numpy(), axis=1, out=cumulative[:, 1:])
+    return cumulative[:, lookback_window:] - cumulative[:, :-lookback_window]
+
+
+def get_windowed_ordered_counts(n_crimes: np.ndarray, features: gpd.GeoDataFrame) -> pd.DataFrame:
+    area_km2 = features.area_km2.to_numpy()
+    density = n_crimes / area_km2
+    order = np.argsort(density)
+    # counts and features share the same row order, so no need to align
+    ordered_counts = pd.DataFrame(
+        {"n_crimes": n_crimes[order], "area_km2": area_km2[order], "density": density[order]},
+        index=features.index[order],
+    )
+    ordered_counts["cum_area"] = np.cumsum(area_km2[order])
     return ordered_counts
 
 
+def f1_score(previous: np.ndarray, current: np.ndarray) -> float:
+    """
+    F1 score of one period's hotspots against the previous period's, as sklearn.metrics.f1_score (including returning 0
+    when neither has any) but without its input validation, which dominates for boolean arrays this size
+    """
+    # 2TP + FP + FN is just the total number of hotspots in both periods
+    denominator = np.count_nonzero(previous) + np.count_nonzero(current)
+    return 2 * np.count_nonzero(previous & current) / denominator if denominator else 0.0
+
+
 st.set_page_config(layout="wide", page_title="Crime Capture", page_icon="👮")
 st.logo("./assets/safer-streets-small.png", size="large")
 
@@ -76,14 +96,11 @@ rank-biased overlap, Spearman rank correlation
 
     try:
         with st.spinner("Loading crime and demographic data..."):
-            raw_data, boundary = cache_crime_data(force, category)
             raw_population = cache_demographic_data(force)
 
             # map crimes to features
             spatial_unit, spatial_unit_params = geographies[spatial_unit_name]
-            counts, features, boundary = get_counts_and_features_old(
-                raw_data, boundary, spatial_unit, **spatial_unit_params
-            )
+            counts, features, boundary = cache_counts_and_features(force, category, spatial_unit, **spatial_unit_params)
             total_area = features.area_km2.sum()
 
         area_threshold = st.sidebar.slider(
@@ -119,79 +136,109 @@ rank-biased overlap, Spearman rank correlation
             ethnicity = get_ethnicity(raw_population, features)
             ethnicity_average = ethnicity.sum() / ethnicity.sum().sum()
 
-            mean_density = counts.sum().sum() / observation_period / features.area_km2.sum()
-            summary = pd.Series()
-            summary["Population (2021)"] = ethnicity.sum().sum()
-
-            summary["Overall Annual crime rate"] = counts.sum().sum() / observation_period
-            summary["Number of spatial units"] = len(features)
-            summary["Average crime rate per spatial unit"] = counts.sum().sum() / observation_period / len(features)
-            summary["Maximum crime rate per spatial unit"] = counts.sum(axis=1).max() / observation_period
-            summary["Minimum crime rate per spatial unit"] = counts.sum(axis=1).min() / observation_period
-
-            summary["Average population per spatial unit"] = ethnicity.sum().sum() / len(features)
-            summary["Maximum population per spatial unit"] = ethnicity.sum(axis=1).max()
-            summary["Minimum population per spatial unit"] = ethnicity.sum(axis=1).min()
-
-            summary = pd.concat([summary, 100 * ethnicity_average])
-
-            summary["Total land area (km²)"] = features.area_km2.sum()
-            summary["Average land area per spatial unit"] = features.area_km2.mean()
-            summary["Maximum land area per spatial unit"] = features.area_km2.max()
-            summary["Minimum land area per spatial unit"] = features.area_km2.min()
-
+            crimes_per_unit = counts.to_numpy().sum(axis=1)
+            population_per_unit = ethnicity.to_numpy().sum(axis=1)
+            mean_density = crimes_per_unit.sum() / observation_period / features.area_km2.sum()
+
+            # collect the values in a dict and build the series once, rather than growing it an entry at a time
+            summary = pd.Series(
+                {
+                    "Population (2021)": population_per_unit.sum(),
+                    "Overall Annual crime rate": crimes_per_unit.sum() / observation_period,
+                    "Number of spatial units": len(features),
+                    "Average crime rate per spatial unit": crimes_per_unit.sum() / observation_period / len(features),
+                    "Maximum crime rate per spatial unit": crimes_per_unit.max() / observation_period,
+                    "Minimum crime rate per spatial unit": crimes_per_unit.min() / observation_period,
+                    "Average population per spatial unit": population_per_unit.sum() / len(features),
+                    "Maximum population per spatial unit": population_per_unit.max(),
+                    "Minimum population per spatial unit": population_per_unit.min(),
+                    **(100 * ethnicity_average).to_dict(),
+                    "Total land area (km²)": features.area_km2.sum(),
+                    "Average land area per spatial unit": features.area_km2.mean(),
+                    "Maximum land area per spatial unit": features.area_km2.max(),
+                    "Minimum land area per spatial unit": features.area_km2.min(),
+                },
+                name="Value",
+            )
             summary.index.name = "Property"
-            summary.name = "Value"
-
-            ethnicity_in_hotspots = pd.DataFrame(columns=ethnicity.columns)
-
-            concentration_measures = pd.DataFrame(columns=["Gini", "Captured proportion", "Density Ratio"])
-            lorenz_curves = pd.DataFrame()
 
-            consistency_measures = pd.DataFrame(
-                columns=["Cosine similarity", "F1 score", "Rank-biased overlap", "Spearman rank correlation"]
+            # the window sums assume consecutive, complete month columns, so lay the counts out over all_months (zero
+            # for any month missing from the data) rather than trusting the columns as loaded
+            window_counts = get_window_counts(
+                counts.reindex(columns=[str(month) for month in all_months], fill_value=0), lookback_window
             )
+            months = all_months[lookback_window - 1 :]
+            periods = [
+                f"{month - lookback_window + 1} to {month}" if lookback_window > 1 else f"{month}" for month in months
+            ]
 
-            captured_by_period = pd.DataFrame(index=features.index)
-
-            previous_period = None
-            previous_ordered_counts = None
-            # for c in counts.T.rolling(lookback_window):
-            for month in all_months[lookback_window - 1 :]:
-                ordered_counts = get_windowed_ordered_counts(counts, month, lookback_window, features)
-
-                period = f"{month - lookback_window + 1} to {month}" if lookback_window > 1 else f"{month}"
+            # the window ending at months[i] starts at all_months[i], which is column i of window_counts
+            windows = list(range(len(months)))
 
+            def measure(window: int) -> tuple[pd.DataFrame, pd.Series, pd.Series, float]:
+                "Ordered counts, hotspots, Lorenz curve and Gini for one lookback window"
+                ordered_counts = get_windowed_ordered_counts(window_counts[:, window], features)
                 # deal with case where we've captured all incidents in a smaller area than specified
                 hits = (ordered_counts.cum_area >= total_area - area_threshold) & (ordered_counts.n_crimes > 0)
-
-                captured_by_period[period] = hits
-                lorenz_curves[period] = lorenz_curve(ordered_counts, data_col="n_crimes")
-                concentration_measures.loc[period, "Gini"] = calc_gini(lorenz_curves[period])
-                concentration_measures.loc[period, "Captured proportion"] = (
-                    ordered_counts[hits].n_crimes.sum() / ordered_counts.n_crimes.sum()
-                )
-                concentration_measures.loc[period, "Density Ratio"] = (
-                    ordered_counts[hits].n_crimes.sum() / features[hits].area_km2.sum() / mean_density
+                lorenz = lorenz_curve(ordered_counts, data_col="n_crimes")
+                return ordered_counts, hits, lorenz, calc_gini(lorenz)
+
+            def compare(previous: pd.DataFrame, current: pd.DataFrame) -> tuple[float, float, float]:
+                "Cosine similarity, rank-biased overlap and Spearman correlation between consecutive periods"
+                count_comparison = current[["n_crimes"]].join(previous.n_crimes.rename("previous"))
+                return (
+                    cosine_similarity(count_comparison),
+                    rank_biased_overlap(count_comparison),
+                    spearman_rank_correlation(count_comparison),
                 )
 
-                if previous_period:
-                    consistency_measures.loc[period, "F1 score"] = f1_score(
-                        captured_by_period[previous_period], captured_by_period[period]
-                    )
-                    count_comparison = ordered_counts[["n_crimes"]].join(
-                        previous_ordered_counts.n_crimes.rename("previous")
-                    )
-                    consistency_measures.loc[period, "Cosine similarity"] = cosine_similarity(count_comparison)
-
-                    consistency_measures.loc[period, "Spearman rank correlation"] = spearman_rank_correlation(
-                        count_comparison
-                    )
-                    consistency_measures.loc[period, "Rank-biased overlap"] = rank_biased_overlap(count_comparison)
-                ethnicity_in_hotspots.loc[period] = ethnicity.loc[ordered_counts[hits].index].sum().T
-
-                previous_period = period
-                previous_ordered_counts = ordered_counts
+            measured = [measure(window) for window in windows]
+            ordered = [ordered_counts for ordered_counts, *_ in measured]
+            compared = [compare(previous, current) for previous, current in zip(ordered[:-1], ordered[1:], strict=True)]
+
+            # per-period measures are written by position into preallocated arrays and the tables built after the loop
+            gini = np.empty(len(periods))
+            captured_proportion = np.empty(len(periods))
+            density_ratio = np.empty(len(periods))
+            ethnicity_counts = np.zeros((len(periods), ethnicity.shape[1]))
+            # consistency compares each period with the previous one, so there is no value for the first
+            cosine, rbo, spearman = np.array(compared).reshape(-1, 3).T
+            f1 = np.empty(len(periods) - 1)
+            # built in one go, aligned to the first curve's index as assigning the columns one at a time would do
+            lorenz_curves = pd.DataFrame(
+                {period: lorenz for period, (_, _, lorenz, _) in zip(periods, measured, strict=True)},
+                index=measured[0][2].index,
+            )
+
+            # hotspots for each period as a column, with rows in the same order as features
+            captured = np.zeros((len(features), len(periods)), dtype=bool)
+
+            for i, (ordered_counts, hits, _, period_gini) in enumerate(measured):
+                # hits are in density order, which differs between periods, so realign before storing
+                captured[:, i] = hits.reindex(features.index).to_numpy()
+                gini[i] = period_gini
+                captured_proportion[i] = ordered_counts[hits].n_crimes.sum() / ordered_counts.n_crimes.sum()
+                density_ratio[i] = (
+                    ordered_counts[hits].n_crimes.sum() / ordered_counts[hits].area_km2.sum() / mean_density
+                )
+                if i > 0:
+                    f1[i - 1] = f1_score(captured[:, i - 1], captured[:, i])
+                ethnicity_counts[i] = ethnicity.loc[ordered_counts[hits].index].sum().to_numpy()
+
+            ethnicity_in_hotspots = pd.DataFrame(ethnicity_counts, index=periods, columns=ethnicity.columns)
+            concentration_measures = pd.DataFrame(
+                {"Gini": gini, "Captured proportion": captured_proportion, "Density Ratio": density_ratio},
+                index=periods,
+            )
+            consistency_measures = pd.DataFrame(
+                {
+                    "Cosine similarity": cosine,
+                    "F1 score": f1,
+                    "Rank-biased overlap": rbo,
+                    "Spearman rank correlation": spearman,
+                },
+                index=periods[1:],
+            )
 
         st.markdown(
             f"## {category} in {force} PFA, {counts.columns[0]} to {counts.columns[-1]}\n"
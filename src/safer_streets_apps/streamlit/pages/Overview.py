@@ -9,14 +9,13 @@ import pandas as pd
 import pydeck as pdk
 import streamlit as st
 from dotenv import load_dotenv
-from itrx import Itr
 from safer_streets_core.utils import (
     CATEGORIES,
     CrimeType,
     Force,
+    Month,
     data_dir,
     fix_force_name,
-    monthgen,
 )
 
 from safer_streets_apps.streamlit.common import latest_month
@@ -48,10 +47,15 @@ def get_crime_counts() -> pd.DataFrame:
 
 @st.cache_data
 def simplified_pfa_boundaries() -> tuple[dict[str, Any], dict[str, Any]]:
-    force_boundaries = gpd.read_file(data_dir() / "Police_Force_Areas_December_2023_EW_BFE_2734900428741300179.zip")
+    # only the name is needed, so don't read the other attribute columns
+    force_boundaries = gpd.read_file(
+        data_dir() / "Police_Force_Areas_December_2023_EW_BFE_2734900428741300179.zip", columns=["PFA23NM"]
+    )
     # this should be significantly smaller than a hex (although its not used in a spatial join)
     force_boundaries.geometry = force_boundaries.simplify(tolerance=50)
     force_boundaries = force_boundaries.to_crs(epsg=4326)
+    # snap to ~0.1m to shorten the coordinates in the GeoJSON sent to the browser
+    force_boundaries.geometry = force_boundaries.geometry.set_precision(1e-6)
 
     return (
         force_boundaries[force_boundaries.PFA23NM.isin(FORCES_FOR_MAP)][["PFA23NM", "geometry"]],
@@ -59,7 +63,14 @@ def simplified_pfa_boundaries() -> tuple[dict[str, Any], dict[str, Any]]:
     )
 
 
-MONTHS = Itr(monthgen(latest_month(), backwards=True)).take(N_MONTHS).rev().collect()
+@st.cache_resource
+def _months() -> list[Month]:
+    "The last N_MONTHS months, oldest first"
+    latest = latest_month()
+    return [latest - i for i in range(N_MONTHS - 1, -1, -1)]
+
+
+MONTHS = _months()
 
 
 def main() -> None:
@@ -1,8 +1,13 @@
+from io import BytesIO
+from pathlib import Path
 from typing import cast, get_args
 
-import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import streamlit as st
+from matplotlib.colors import to_rgba_array
+from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
 from safer_streets_core.utils import CATEGORIES, DEFAULT_FORCE, Force, data_dir
 
 CONSISTENCY_MEASURES = ("RBO_7", "RBO_8", "RBO_9", "F1_10", "F1_20", "F1_50")
@@ -50,18 +55,6 @@ st.set_page_config(layout="wide", page_title="Crime Tradeoff", page_icon="👮")
 st.logo("./assets/safer-streets-small.png", size="large")
 
 
-def _get_ax(axs, i: int, j: int, ni, nj):
-    match ni, nj:
-        case 1, 1:
-            return axs
-        case 1, _:
-            return axs[j]
-        case _, 1:
-            return axs[i]
-        case _, _:
-            return axs[j, i]
-
-
 def _get_count_label(data: pd.Series) -> str:
     mean_count = data.mean()
     if mean_count < 0.5:
@@ -69,13 +62,111 @@ def _get_count_label(data: pd.Series) -> str:
     return f"n~{mean_count:.0f}"
 
 
-@st.cache_data
-def _cache_tradeoff_data(force: Force) -> pd.DataFrame:
+def _tradeoff_file(force: Force) -> Path:
     # script that generates this data: safer-streets-eda/tradeoff.py
-    return pd.read_parquet(data_dir() / f"tradeoff_results_{force}.parquet")
+    return data_dir() / f"tradeoff_results_{force}.parquet"
+
+
+@st.cache_data
+def _cache_tradeoff_data(force: Force) -> dict[tuple[str, int], pd.DataFrame]:
+    """
+    The force's results split by (category, time window), each indexed by spatial unit, so selecting one is a dict
+    lookup rather than slicing the MultiIndex
+    """
+    data = pd.read_parquet(
+        _tradeoff_file(force),
+        columns=["Count", *CONCENTRATION_MEASURES, *CONSISTENCY_MEASURES],
+    )
+    # concentration has an extra value for the first window, which has no previous window to be consistent with, so
+    # drop it here once rather than every time the points are assembled
+    for measure in CONCENTRATION_MEASURES:
+        data[measure] = data[measure].map(lambda values: values[1:])
+    # index levels are category, spatial unit, time window
+    return {key: rows.droplevel([0, 2]) for key, rows in data.groupby(level=[0, 2], sort=False)}
+
+
+@st.cache_data
+def _cache_tradeoff_keys(force: Force) -> set[tuple[str, int]]:
+    "The (category, time window) combinations the force has results for"
+    return set(_cache_tradeoff_data(force))
 
 
-def main() -> None:  # noqa: C901
+@st.cache_data
+def _cache_plot_data(
+    force: Force, category: str, time_window: int
+) -> tuple[list[str], np.ndarray, dict[str, np.ndarray]]:
+    """
+    Legend labels, the spatial unit each point belongs to, and every measure's points flattened across the units.
+    Cached so that changing the selected measures doesn't slice the table again
+    """
+    data = _cache_tradeoff_data(force)[category, time_window]
+    labels = [f"{idx} ({_get_count_label(count)})" for idx, count in data.Count.items()]
+    unit = np.repeat(np.arange(len(data)), [len(values) for values in data[CONSISTENCY_MEASURES[0]]])
+    # the measures are all in [0, 1] and only plotted, so single precision is plenty
+    points = {
+        measure: np.concatenate(data[measure].to_list(), dtype=np.float32)
+        for measure in CONCENTRATION_MEASURES + CONSISTENCY_MEASURES
+    }
+    return labels, unit, points
+
+
+@st.cache_data(max_entries=256)
+def _cache_tradeoff_png(
+    force: Force,
+    category: str,
+    time_window: int,
+    concentration_measures: tuple[str, ...],
+    consistency_measures: tuple[str, ...],
+    fixed_axes: bool,
+) -> bytes:
+    """
+    The scatter grid rendered as a png. The chart depends only on the sidebar settings, so revisiting a combination
+    skips matplotlib altogether
+    """
+    labels, unit, points = _cache_plot_data(force, category, time_window)
+    # one colour per spatial unit, from the default colour cycle
+    colours = to_rgba_array([f"C{k}" for k in range(len(labels))])
+    point_colours = colours[unit]
+    # the scatter has no per-unit artists, so the legend needs proxies (which are opaque). Every panel shows the same
+    # units in the same colours, so one legend serves the whole figure
+    handles = [
+        Line2D([], [], marker="o", linestyle="", color=colour, label=label)
+        for label, colour in zip(labels, colours, strict=True)
+    ]
+
+    # a standalone Figure isn't registered with pyplot, so isn't kept alive after rendering. 4 inches per panel, so a
+    # small grid isn't scaled up to the full 12x12 inches
+    fig = Figure(figsize=(4 * len(concentration_measures), 4 * len(consistency_measures)), layout="constrained")
+    # always a 2d array of axes, whatever the number of measures selected. Fixed axes set every y range to [0, 1]
+    # anyway, so they are only shared when the scales are left free
+    axs = fig.subplots(len(consistency_measures), len(concentration_measures), sharey=not fixed_axes, squeeze=False)
+
+    for i, x in enumerate(concentration_measures):
+        for j, y in enumerate(consistency_measures):
+            ax = axs[j, i]
+            # one scatter call for every spatial unit's points, coloured by unit, rather than a call per unit
+            ax.scatter(points[x], points[y], c=point_colours, alpha=0.5, rasterized=True)
+            if fixed_axes:
+                ax.set_xlim(0, 1)
+                ax.set_ylim(0, 1)
+            if j == len(consistency_measures) - 1:
+                ax.set_xlabel(f"Concentration ({x})")
+            if i == 0:
+                ax.set_ylabel(f"Consistency ({y})")
+            # invert if L-measure (means we can't have sharex=True)
+            if x.startswith("L"):
+                ax.xaxis.set_inverted(True)
+
+    # the constrained layout makes room for it below the axes
+    fig.legend(handles=handles, loc="outside lower center", ncols=min(len(handles), 6))
+
+    png = BytesIO()
+    # at the size it's displayed, rather than the 200dpi st.pyplot would use
+    fig.savefig(png, format="png", dpi=96, bbox_inches="tight")
+    return png.getvalue()
+
+
+def main() -> None:
     "Entry point"
     st.title("Crime Tradeoff: Concentration vs Consistency")
 
@@ -104,40 +195,19 @@ def main() -> None:  # noqa: C901
         st.warning("**Select up to 2 each from concentration and consistency measures**")
         return
 
-    try:
-        tradeoff_data = _cache_tradeoff_data(force).loc[category]
-
-        fig, axs = plt.subplots(len(consistency_measures), len(concentration_measures), figsize=(12, 12), sharey=True)
-
-        for i, x in enumerate(concentration_measures):
-            for j, y in enumerate(consistency_measures):
-                ax = _get_ax(axs, i, j, len(concentration_measures), len(consistency_measures))
-                for idx, data in tradeoff_data[["Count", x, y]].xs(time_window, level=1).iterrows():
-                    label = f"{idx} ({_get_count_label(data.Count)})"
-                    ax.scatter(data[x][1:], data[y], label=label, alpha=0.5)
-                    # legend not working
-                    # sns.kdeplot(x=data[x][1:], y=data[y], label=idx, fill=True, ax=ax)
-
-                legend = ax.legend()
-                for item in legend.legend_handles:
-                    item.set_alpha(1)
-                if fixed_axes:
-                    ax.set_xlim(0, 1)
-                    ax.set_ylim(0, 1)
-                if j == len(consistency_measures) - 1:
-                    ax.set_xlabel(f"Concentration ({x})")
-                if i == 0:
-                    ax.set_ylabel(f"Consistency ({y})")
-                # invert if L-measure (means we can't have sharex=True)
-                if x.startswith("L"):
-                    ax.xaxis.set_inverted(True)
-
-        st.markdown(f"### {category} in {force}, {time_window}-month windows")
-        plt.tight_layout()
-        st.pyplot(fig)
-
-    except Exception as e:
-        st.error(e)
+    if not _tradeoff_file(force).exists():
+        st.warning(f"**Tradeoff data is not available for {force}**")
+        return
+
+    if (category, time_window) not in _cache_tradeoff_keys(force):
+        st.warning(f"**No tradeoff data for {category} in {force} with {time_window}-month windows**")
+        return
+
+    png = _cache_tradeoff_png(
+        force, category, time_window, tuple(concentration_measures), tuple(consistency_measures), fixed_axes
+    )
+    st.markdown(f"### {category} in {force}, {time_window}-month windows")
+    st.image(png)
 
 
 if __name__ == "__main__":
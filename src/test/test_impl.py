@@ -0,0 +1,28 @@
+import duckdb
+
+from safer_streets_apps.fastapi.impl import pivot_monthly_counts
+
+MONTHS = ["2025-01", "2025-02", "2025-03"]
+
+
+def test_pivot_monthly_counts() -> None:
+    con = duckdb.connect()
+    counts = con.sql(
+        "SELECT * FROM (VALUES (1, '2025-01', 3), (1, '2025-02', 1), (2, '2025-02', 4)) t(spatial_unit, month, count)"
+    )
+    result = sorted(pivot_monthly_counts(counts, MONTHS), key=lambda row: row["spatial_unit"])
+    assert result == [
+        {"spatial_unit": 1, "2025-01": 3, "2025-02": 1, "2025-03": 0},
+        {"spatial_unit": 2, "2025-01": 0, "2025-02": 4, "2025-03": 0},
+    ]
+
+
+def test_pivot_monthly_counts_parameterised() -> None:
+    # as in hex_counts_wide, the relation comes from a query with bound parameters
+    con = duckdb.connect()
+    counts = con.sql(
+        "SELECT * FROM (VALUES (1, '2024-12', 2), (1, '2025-01', 3)) t(spatial_unit, month, count) "
+        "WHERE month IN $months",
+        params={"months": MONTHS},
+    )
+    assert pivot_monthly_counts(counts, MONTHS) == [{"spatial_unit": 1, "2025-01": 3, "2025-02": 0, "2025-03": 0}]